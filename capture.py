@@ -2,6 +2,24 @@
 import os, json, time, pathlib, yaml
 from datetime import datetime, timezone
 
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml-backed
+except ImportError:
+    from yaml import SafeLoader
+
+# Optional: pip install orjson  (faster meta.json encoding, emits bytes directly)
+try:
+    import orjson
+    def dumps_json(obj): return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    def dumps_json(obj): return json.dumps(obj, indent=2).encode("utf-8")
+
+# Optional: pip install liburing  (batched camera reads via io_uring on Linux)
+try:
+    import liburing
+except Exception:
+    liburing = None
+
 def iso_utc():
     return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
 
@@ -10,21 +28,84 @@ def atomic_write(path, data_bytes):
     with open(tmp, "wb") as f: f.write(data_bytes)
     os.replace(tmp, path)
 
+def read_files_plain(srcs):
+    out = {}
+    for name, src in srcs.items():
+        try:
+            with open(src, "rb") as f: out[name] = f.read()
+        except Exception as e:
+            out[name] = e
+    return out
+
+def read_files_uring(srcs):
+    """
+    Read every source in one io_uring submission instead of one blocking
+    read() per file. Returns {name: bytes | Exception}, like read_files_plain.
+    """
+    out, fds, bufs, names = {}, [], [], []
+    ring = None
+    try:
+        for name, src in srcs.items():
+            try:
+                fd = os.open(src, os.O_RDONLY)
+            except Exception as e:
+                out[name] = e
+                continue
+            fds.append(fd); names.append(name)
+            bufs.append(bytearray(os.fstat(fd).st_size))
+        if not fds:
+            return out
+        cqes = liburing.io_uring_cqes()
+        r = liburing.io_uring()
+        liburing.io_uring_queue_init(len(fds) * 2, r, 0)
+        ring = r  # only set once init succeeded, so we never exit a dead ring
+        for i, (fd, buf) in enumerate(zip(fds, bufs)):
+            sqe = liburing.io_uring_get_sqe(ring)
+            liburing.io_uring_prep_read(sqe, fd, buf, len(buf), 0)
+            sqe.user_data = i
+        liburing.io_uring_submit(ring)
+        for _ in fds:
+            liburing.io_uring_wait_cqe(ring, cqes)
+            cqe = cqes[0]
+            i, res = cqe.user_data, cqe.res
+            liburing.io_uring_cqe_seen(ring, cqe)
+            if res < 0:
+                out[names[i]] = OSError(-res, os.strerror(-res))
+            elif res < len(bufs[i]):
+                # short read: finish the tail synchronously
+                out[names[i]] = bytes(bufs[i][:res]) + os.pread(fds[i], len(bufs[i]) - res, res)
+            else:
+                out[names[i]] = bufs[i]
+    finally:
+        if ring is not None:
+            liburing.io_uring_queue_exit(ring)
+        for fd in fds: os.close(fd)
+    return out
+
+def read_files(srcs):
+    if liburing is not None:
+        try:
+            return read_files_uring(srcs)
+        except Exception:
+            pass  # kernel without io_uring, seccomp, etc.
+    return read_files_plain(srcs)
+
 with open("config.yaml", "r") as f:
-    cfg = yaml.safe_load(f)
+    cfg = yaml.load(f, Loader=SafeLoader)
 
 root = pathlib.Path(cfg["data_root"]); root.mkdir(parents=True, exist_ok=True)
 
 now = datetime.now(timezone.utc).replace(microsecond=0)
-yyyy, mm, dd = now.strftime("%Y"), now.strftime("%m"), now.strftime("%d")
-stamp = now.strftime("%H%M%SZ")
-batch = root / yyyy / mm / dd / stamp
-batch.mkdir(parents=True, exist_ok=True)
+now_iso = now.isoformat()
+batch = root / now.strftime("%Y/%m/%d/%H%M%SZ")
+os.makedirs(batch, exist_ok=True)
 
 cam_status = []
-for name, src in cfg["cameras"]["mock_files"].items():
+cam_data = read_files(cfg["cameras"]["mock_files"])
+for name in cfg["cameras"]["mock_files"]:
+    data = cam_data[name]
     try:
-        data = open(src, "rb").read()
+        if isinstance(data, Exception): raise data
         atomic_write(batch / f"{name}.jpg", data)
         cam_status.append({"name": name, "filename": f"{name}.jpg", "ok": True})
     except Exception as e:
@@ -35,11 +116,11 @@ time.sleep(fix.get("delay_ms", 0)/1000.0)
 fix.update({"stale": False, "source": "mock", "fix_timestamp_utc": iso_utc()})
 
 meta = {
-    "batch_id": now.isoformat(),
-    "timestamp_utc": now.isoformat(),
+    "batch_id": now_iso,
+    "timestamp_utc": now_iso,
     "gps": fix,
     "cameras": cam_status,
     "notes": []
 }
-atomic_write(batch / "meta.json", json.dumps(meta, indent=2).encode("utf-8"))
+atomic_write(batch / "meta.json", dumps_json(meta))
 print(f"Saved batch: {batch}")
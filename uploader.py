@@ -1,183 +1,830 @@
 #!/usr/bin/env python3
-import os, sys, json, time, shutil, socket, pathlib
-from datetime import datetime, timezone
+import os, re, sys, json, time, queue, shlex, shutil, socket, sqlite3, pathlib, threading, contextlib
+from concurrent.futures import ThreadPoolExecutor
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml-backed
+except ImportError:
+    from yaml import SafeLoader
 
 # Optional deps by backend:
 #   pip install boto3         (for S3)
 #   pip install paramiko      (for SFTP)
-#   pip install requests      (for quick connectivity check, otherwise use socket)
-try:
-    import requests
-except Exception:
-    requests = None
 
-DATA_GLOB_DEPTH = 4  # /YYYY/MM/DD/HHMMSSZ/
+_YEAR_RE = re.compile(r"[0-9]{4}")
+_MONTH_RE = re.compile(r"0[1-9]|1[0-2]")
+_DAY_RE = re.compile(r"0[1-9]|[12][0-9]|3[01]")
+_STAMP_RE = re.compile(r"[0-9]{6}Z")
+_BATCH_RE = re.compile(r"[0-9]{4}/(0[1-9]|1[0-2])/(0[1-9]|[12][0-9]|3[01])/[0-9]{6}Z")
 
-def internet_up(timeout=2.0) -> bool:
+def internet_up(timeout=1.0, ttl=30.0, cache_path=None) -> bool:
     """
     Returns True if we appear to have internet.
-    Strategy: try a very fast HTTP request; fall back to DNS socket if requests missing.
+    Strategy: plain TCP connect to a public DNS server (no TLS). If `cache_path`
+    is given, the result is kept there for `ttl` seconds (its mtime is the probe
+    time), so back-to-back cron runs and watchdog wakeups share one probe.
     """
+    if cache_path:
+        try:
+            if time.time() - os.stat(cache_path).st_mtime < ttl:
+                with open(cache_path) as fh:
+                    return fh.read().strip() == "1"
+        except (OSError, ValueError):
+            pass
     try:
-        if requests:
-            r = requests.get("https://www.google.com/generate_204", timeout=timeout)
-            return r.status_code == 204
-        else:
-            # DNS socket fallback (1.1.1.1:53)
-            with socket.create_connection(("1.1.1.1", 53), timeout=timeout):
-                return True
-    except Exception:
-        return False
+        with socket.create_connection(("1.1.1.1", 53), timeout=timeout):
+            result = True
+    except OSError:
+        result = False
+    if cache_path:
+        try:
+            tmp = f"{cache_path}.tmp"
+            with open(tmp, "w") as fh:
+                fh.write("1" if result else "0")
+            os.replace(tmp, cache_path)
+        except OSError:
+            pass  # caching is best-effort
+    return result
+
+def _subdirs(path: str):
+    try:
+        with os.scandir(path) as it:
+            # d_type from the dirent; no extra stat() on most filesystems
+            return [(e.name, e.path) for e in it if e.is_dir(follow_symlinks=False)]
+    except OSError:
+        return []
 
-def find_pending_batches(data_root: str):
+def iter_batches(data_root: str):
     """
-    Yield absolute paths to batch dirs that look like .../YYYY/MM/DD/HHMMSSZ/
-    and do NOT have a '.uploaded' file.
+    Yield (batch_id, path) for every dir that looks like .../YYYY/MM/DD/HHMMSSZ/,
+    where batch_id is the 'YYYY/MM/DD/HHMMSSZ' part.
     """
-    root = pathlib.Path(data_root)
-    if not root.exists():
+    # One scandir per level, pruning non-matching names at each level so other
+    # trees under data_root (e.g. an uploaded/ archive) are never descended into;
+    # the batch id is only assembled for leaves whose stamp matches.
+    if not os.path.isdir(data_root):
         return
-    for year_dir in root.glob("[0-9][0-9][0-9][0-9]"):
-        for month_dir in year_dir.glob("[0-1][0-9]"):
-            for day_dir in month_dir.glob("[0-3][0-9]"):
-                for batch_dir in day_dir.glob("*Z"):
-                    if batch_dir.is_dir():
-                        if not (batch_dir / ".uploaded").exists() and not (batch_dir / ".uploading").exists():
-                            yield batch_dir
-
-def mark_uploading(batch_dir: pathlib.Path):
-    (batch_dir / ".uploading").write_text(datetime.now(timezone.utc).isoformat())
-
-def mark_uploaded(batch_dir: pathlib.Path):
-    # Make idempotent: remove uploading marker and add uploaded marker
+    for y, year_path in _subdirs(data_root):
+        if not _YEAR_RE.fullmatch(y):
+            continue
+        for m, month_path in _subdirs(year_path):
+            if not _MONTH_RE.fullmatch(m):
+                continue
+            for d, day_path in _subdirs(month_path):
+                if not _DAY_RE.fullmatch(d):
+                    continue
+                for b, batch_path in _subdirs(day_path):
+                    if _STAMP_RE.fullmatch(b):
+                        yield f"{y}/{m}/{d}/{b}", batch_path
+
+def find_pending_batches(data_root: str, ledger: "UploadLedger"):
+    """
+    Yield absolute paths to batch dirs that still need uploading. Batches left
+    half-done by a crash or failure are yielded again (after the ledger's
+    backoff) and resume. A batch is only ready once capture has written its
+    meta.json (always last).
+    """
+    skip = ledger.skipped_batches()
+    for batch_id, batch_path in iter_batches(data_root):
+        if batch_id not in skip and os.path.exists(os.path.join(batch_path, "meta.json")):
+            yield pathlib.Path(batch_path)
+
+def batch_id_of(batch_dir: pathlib.Path) -> str:
+    return "/".join(batch_dir.parts[-4:])
+
+class UploadLedger:
+    """
+    Upload progress in SQLite (data_root/uploads.db): one row per uploaded file
+    plus a batch-level row (filename ''), so a crash mid-batch only re-sends
+    the files that didn't make it. Replaces the .uploading/.uploaded markers.
+    Failed batches are retried with exponential backoff (retry_backoff_s,
+    doubling per attempt, capped at retry_backoff_max_s). By default they are
+    retried forever; set max_attempts to give up instead.
+    """
+    BATCH = ""
+
+    def __init__(self, data_root: str, max_attempts=None, retry_backoff_s: float = 300,
+                 retry_backoff_max_s: float = 3600):
+        os.makedirs(data_root, exist_ok=True)
+        path = os.path.join(data_root, "uploads.db")
+        fresh = not os.path.exists(path)
+        self.max_attempts = max_attempts
+        self.retry_backoff_s = retry_backoff_s
+        self.retry_backoff_max_s = retry_backoff_max_s
+        # autocommit; shared by the upload threads under self._lock
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # NORMAL: per-file rows don't fsync, so upload threads don't queue behind
+        # the SD card; mark_uploaded switches to FULL for the batch row only.
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+            batch_id TEXT, filename TEXT, state TEXT, ts REAL, attempts INTEGER DEFAULT 0,
+            PRIMARY KEY (batch_id, filename))""")
+        if fresh:
+            self._import_markers(data_root)
+
+    def _import_markers(self, data_root: str):
+        # One-time migration so batches uploaded before the ledger aren't re-sent
+        for batch_id, batch_path in iter_batches(data_root):
+            if os.path.exists(os.path.join(batch_path, ".uploaded")):
+                self._set(batch_id, self.BATCH, "uploaded")
+
+    def _set(self, batch_id: str, filename: str, state: str, durable: bool = False):
+        with self._lock:
+            if durable:
+                self._db.execute("PRAGMA synchronous=FULL")
+            try:
+                self._db.execute("""INSERT INTO uploads (batch_id, filename, state, ts) VALUES (?, ?, ?, ?)
+                                    ON CONFLICT (batch_id, filename) DO UPDATE SET state = excluded.state, ts = excluded.ts""",
+                                 (batch_id, filename, state, time.time()))
+            finally:
+                if durable:
+                    self._db.execute("PRAGMA synchronous=NORMAL")
+
+    def skipped_batches(self) -> set:
+        """Batches not to hand out: uploaded, backing off after a failure, or given up on."""
+        now = time.time()
+        give_up = self.max_attempts or float("inf")
+        with self._lock:
+            rows = self._db.execute("SELECT batch_id, state, ts, attempts FROM uploads WHERE filename = ?",
+                                    (self.BATCH,)).fetchall()
+        skip = set()
+        for batch_id, state, ts, attempts in rows:
+            if state == "uploaded" or attempts >= give_up:
+                skip.add(batch_id)
+            elif now < ts + min(self.retry_backoff_s * 2 ** min(attempts - 1, 20), self.retry_backoff_max_s):
+                skip.add(batch_id)
+        return skip
+
+    def uploaded_files(self, batch_id: str) -> set:
+        with self._lock:
+            rows = self._db.execute("SELECT filename FROM uploads WHERE batch_id = ? AND filename != ? AND state = 'uploaded'",
+                                    (batch_id, self.BATCH)).fetchall()
+        return {r[0] for r in rows}
+
+    def mark_uploading(self, batch_id: str):
+        # counts as an attempt; a crash leaves it 'uploading' and it backs off like a failure
+        with self._lock:
+            self._db.execute("""INSERT INTO uploads (batch_id, filename, state, ts, attempts) VALUES (?, ?, 'uploading', ?, 1)
+                                ON CONFLICT (batch_id, filename) DO UPDATE SET state = 'uploading', ts = excluded.ts,
+                                attempts = attempts + 1""",
+                             (batch_id, self.BATCH, time.time()))
+
+    def mark_failed(self, batch_id: str):
+        self._set(batch_id, self.BATCH, "failed")
+        with self._lock:
+            attempts = self._db.execute("SELECT attempts FROM uploads WHERE batch_id = ? AND filename = ?",
+                                        (batch_id, self.BATCH)).fetchone()[0]
+        if self.max_attempts and attempts >= self.max_attempts:
+            print(f"[uploader] Giving up on {batch_id} after {attempts} attempts "
+                  f"(reset its row in uploads.db to retry)")
+
+    def mark_uploaded(self, batch_id: str):
+        # fsync'd: the WAL is sequential, so this also persists the batch's file rows
+        self._set(batch_id, self.BATCH, "uploaded", durable=True)
+
+    def mark_file_uploaded(self, batch_id: str, filename: str):
+        self._set(batch_id, filename, "uploaded")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def acquire_run_lock(data_root: str):
+    """
+    Take an exclusive flock on data_root/uploads.lock for the life of the
+    process, so overlapping cron runs never upload the same batch twice.
+    Returns the held fd, or None if another uploader has it.
+    """
+    os.makedirs(data_root, exist_ok=True)
+    fd = os.open(os.path.join(data_root, "uploads.lock"), os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        (batch_dir / ".uploading").unlink(missing_ok=True)
-    except TypeError:
-        # Python <3.8 compatibility
-        try:
-            (batch_dir / ".uploading").unlink()
-        except FileNotFoundError:
-            pass
-    (batch_dir / ".uploaded").write_text(datetime.now(timezone.utc).isoformat())
+        import fcntl
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except ImportError:
+        pass  # no flock on this platform; single-run deployments only
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
 
 # ----------------- Backends -----------------
 
-def upload_batch_local(batch_dir: pathlib.Path, dest_dir: str):
-    dest = pathlib.Path(dest_dir)
+def list_batch_files(batch_dir: pathlib.Path):
+    # Regular files only; legacy .uploading/.uploaded markers stay local
+    with os.scandir(batch_dir) as it:
+        return [pathlib.Path(e.path) for e in it
+                if e.is_file() and e.name not in (".uploading", ".uploaded")]
+
+def prefetch_batches(batches, depth: int = 2):
+    """
+    Yield (batch_dir, files) pairs, listing upcoming batch dirs on a background
+    thread so directory enumeration overlaps with the current upload.
+    """
+    q = queue.Queue(maxsize=depth)
+    done = object()
+
+    def producer():
+        for batch_dir in batches:
+            try:
+                files = list_batch_files(batch_dir)
+            except OSError:
+                files = None  # let the backend list (and report) it
+            q.put((batch_dir, files))
+        q.put(done)
+
+    threading.Thread(target=producer, daemon=True).start()
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        yield item
+
+COPY_BUFSIZE = 1024 * 1024
+def _copy_bytes(src_fd: int, dst_fd: int, size: int):
+    # Kernel-side copy first (reflink/server-side clone where the FS supports it),
+    # then sendfile, then a plain 1 MB readinto loop. A method that stops short
+    # (some FUSE/overlay/proc files report 0 immediately) hands over to the next.
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(src_fd, dst_fd, size - copied)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError):
+        pass
+    if copied == size:
+        return
+    try:
+        while copied < size:
+            n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+            if n == 0:
+                break
+            copied += n
+    except (AttributeError, OSError):
+        pass
+    if copied == size:
+        return
+    # Resume the plain loop where the kernel methods left off
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    buf = bytearray(COPY_BUFSIZE)
+    view = memoryview(buf)
+    with open(src_fd, "rb", buffering=0, closefd=False) as src:
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            written = 0
+            while written < n:
+                written += os.write(dst_fd, view[written:n])
+
+def _fastcopy(src, dst):
+    """copy_function for shutil.copytree: hardlink if possible, else a fast byte copy."""
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        pass
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            _copy_bytes(src_fd, dst_fd, os.fstat(src_fd).st_size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+    return dst
+
+def upload_batch_local(batch_dir: pathlib.Path, cfg: dict):
+    dest = pathlib.Path(cfg["dest_dir"])
     dest.mkdir(parents=True, exist_ok=True)
     # Copy (or move) the whole directory tree—copy keeps a local archive; move is also fine.
     dst = dest / batch_dir.name
     if dst.exists():
         # avoid clobber: add suffix
         dst = dest / f"{batch_dir.name}-{int(time.time())}"
-    shutil.copytree(batch_dir, dst)
+    if cfg.get("move", False) and os.stat(batch_dir).st_dev == os.stat(dest).st_dev:
+        # Same filesystem: a rename is a metadata-only operation
+        os.rename(batch_dir, dst)
+        return True
+    # Copy into a hidden partial dir and rename it into place, so a failed copy
+    # (e.g. ENOSPC) never leaves a half archive behind for the next retry to dodge
+    partial = dest / f".{'-'.join(batch_dir.parts[-4:])}.partial"
+    shutil.rmtree(partial, ignore_errors=True)
+    try:
+        shutil.copytree(batch_dir, partial, copy_function=_fastcopy)
+        os.rename(partial, dst)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
     return True
 
-def upload_batch_s3(batch_dir: pathlib.Path, cfg: dict):
-    import boto3
-    s3 = boto3.client("s3", region_name=cfg.get("region"))
+_s3_client = None
+_s3_lock = threading.Lock()
+
+def get_s3_client(cfg: dict, batch_concurrency: int = 1):
+    """
+    Return a process-wide boto3 S3 client (boto3 clients are thread-safe).
+    The connection pool is sized so concurrent uploads don't queue on it:
+    each in-flight batch uses up to `concurrency` PUTs plus `concurrency`
+    multipart parts.
+    """
+    global _s3_client
+    with _s3_lock:
+        if _s3_client is None:
+            import boto3
+            from botocore.config import Config
+            pool = batch_concurrency * cfg.get("concurrency", 8) * 2
+            _s3_client = boto3.client("s3", region_name=cfg.get("region"),
+                                      config=Config(max_pool_connections=pool))
+        return _s3_client
+
+S3_PREREAD_MAX = 1024 * 1024  # bytes; larger files aren't buffered in memory
+
+def upload_batch_s3(batch_dir: pathlib.Path, cfg: dict, files=None, on_uploaded=None):
+    from boto3.s3.transfer import TransferConfig
+    s3 = get_s3_client(cfg)
+    workers = cfg.get("concurrency", 8)
+    # Small files go as a single PUT; large ones (RAW/video) fan out into parallel parts
+    part = cfg.get("multipart_mb", 8) * 1024 * 1024
+    tc = TransferConfig(multipart_threshold=part, multipart_chunksize=part,
+                        max_concurrency=workers, use_threads=True)
     bucket = cfg["bucket"]
     prefix = cfg.get("prefix", "")
     # Use batch folder name (e.g., 153000Z) and its YYYY/MM/DD parents in the key
     # Build relative path from data_root
-    files = [p for p in batch_dir.iterdir() if p.is_file()]
-    # Upload each file
+    if files is None:
+        files = list_batch_files(batch_dir)
     # Key structure: prefix/YYYY/MM/DD/HHMMSSZ/filename
     parts = list(batch_dir.parts)
     # find last 4 (YYYY/MM/DD/HHMMSSZ)
     yyyy, mm, dd, stamp = parts[-4], parts[-3], parts[-2], parts[-1]
+
+    def key_for(f):
+        return f"{prefix}{yyyy}/{mm}/{dd}/{stamp}/{f.name}"
+
+    def done(f):
+        if on_uploaded:
+            on_uploaded(f)
+
+    # Only files up to S3_PREREAD_MAX are read into memory, which keeps the
+    # buffered bytes per batch at roughly (workers + 5) MB. Bigger ones are
+    # streamed from disk by upload_file.
+    small, large = [], []
     for f in files:
-        key = f"{prefix}{yyyy}/{mm}/{dd}/{stamp}/{f.name}"
-        s3.upload_file(str(f), bucket, key)
-    return True
+        size = f.stat().st_size
+        if size > part:
+            large.append(f)
+        else:
+            small.append((f, size))
+
+    # Small files: one reader thread pulls bytes off disk while the workers PUT
+    # the previous ones, so disk reads hide behind network latency.
+    q = queue.Queue(maxsize=4)
+
+    def reader():
+        try:
+            for f, size in small:
+                try:
+                    # None: too big to buffer, the sender streams it instead
+                    q.put((f, f.read_bytes() if size <= S3_PREREAD_MAX else None))
+                except OSError as e:
+                    q.put((f, e))
+        finally:
+            for _ in range(workers):
+                q.put(None)
+
+    def sender():
+        errs = []
+        while True:
+            item = q.get()
+            if item is None:
+                return errs
+            f, data = item
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                if data is None:
+                    s3.upload_file(str(f), bucket, key_for(f), Config=tc)
+                else:
+                    s3.put_object(Bucket=bucket, Key=key_for(f), Body=data)
+                done(f)
+            except Exception as e:
+                errs.append((f, e))
+
+    # Multipart-sized files: one at a time, each streamed from disk as parallel
+    # parts, alongside the senders
+    def put_large():
+        errs = []
+        for f in large:
+            try:
+                s3.upload_file(str(f), bucket, key_for(f), Config=tc)
+                done(f)
+            except Exception as e:
+                errs.append((f, e))
+        return errs
 
-def upload_batch_sftp(batch_dir: pathlib.Path, cfg: dict):
-    import paramiko
-    host = cfg["host"]; port = cfg.get("port", 22)
-    username = cfg["username"]
+    threading.Thread(target=reader, daemon=True).start()
+    with ThreadPoolExecutor(max_workers=workers + 1) as ex:
+        futures = [ex.submit(sender) for _ in range(workers)]
+        futures.append(ex.submit(put_large))
+        errors = [err for fut in futures for err in fut.result()]
+    for f, e in errors:
+        print(f"[uploader] S3 upload failed for {f}: {e}")
+    return not errors
+
+SFTP_COPY_BUFSIZE = 1024 * 1024
+SFTP_EXEC_TIMEOUT = 10  # seconds to wait for the remote `mkdir -p`
+
+def sftp_fast_put(sftp, local, remote: str):
+    """
+    Like sftp.put(), but pipelined: writes are sent without waiting for each
+    chunk's ACK, which keeps the SSH window full on high-latency links.
+    """
+    with open(local, "rb") as src, sftp.open(remote, "wb") as dst:
+        dst.set_pipelined(True)
+        shutil.copyfileobj(src, dst, SFTP_COPY_BUFSIZE)
+
+class SFTPPool:
+    """
+    Keeps one SSH connection open across batches and lends out SFTP channels
+    multiplexed over its transport, so the handshake + auth is paid once.
+    Capped at `size` channels to stay well under sshd's MaxSessions/MaxStartups.
+    """
+    def __init__(self, cfg: dict, size: int = 4):
+        self.cfg = cfg
+        self.size = size
+        self._idle = []
+        self._cond = threading.Condition()  # guards _idle/_open; notified on every release
+        self._lock = threading.Lock()       # guards the SSH connection
+        self._open = 0
+        self._ssh = None
+        self._made_dirs = set()
+
+    def _transport(self):
+        # Caller holds self._lock
+        import paramiko
+        if self._ssh is not None and self._ssh.get_transport() and self._ssh.get_transport().is_active():
+            return self._ssh.get_transport()
+        cfg = self.cfg
+        host = cfg["host"]; port = cfg.get("port", 22)
+        username = cfg["username"]
+        pkey_path = cfg.get("private_key")
+        password = cfg.get("password")  # discourage, but allow
+
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if pkey_path:
+            key = paramiko.Ed25519Key.from_private_key_file(pkey_path) if pkey_path.endswith("ed25519") \
+                  else paramiko.RSAKey.from_private_key_file(pkey_path)
+            ssh.connect(host, port=port, username=username, pkey=key, timeout=10)
+        else:
+            ssh.connect(host, port=port, username=username, password=password, timeout=10)
+        ssh.get_transport().set_keepalive(30)
+        self._ssh = ssh
+        return ssh.get_transport()
+
+    def _discard(self, sftp):
+        # Caller holds self._cond
+        try:
+            sftp.close()
+        except Exception:
+            pass
+        self._open -= 1
+        self._cond.notify()
+
+    def _get(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    sftp = self._idle.pop()
+                    if sftp.get_channel().get_transport().is_active():
+                        return sftp
+                    # stale channel from a dropped connection
+                    self._discard(sftp)
+                if self._open < self.size:
+                    self._open += 1  # reserve the slot, open it outside the condition
+                    break
+                self._cond.wait()
+        try:
+            import paramiko
+            with self._lock:
+                return paramiko.SFTPClient.from_transport(self._transport())
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def _exec_mkdir(self, path: str) -> bool:
+        import paramiko
+        with self._lock:
+            self._transport()
+            ssh = self._ssh
+        try:
+            stdin, stdout, _ = ssh.exec_command(f"mkdir -p {shlex.quote(path)}", timeout=SFTP_EXEC_TIMEOUT)
+            chan = stdout.channel
+            try:
+                # EOF on stdin lets a forced sftp-server exit instead of waiting on us
+                chan.shutdown_write()
+                return chan.status_event.wait(SFTP_EXEC_TIMEOUT) and chan.recv_exit_status() == 0
+            finally:
+                chan.close()
+        except (paramiko.SSHException, OSError):
+            return False
+
+    def mkdir_p(self, path: str):
+        """
+        Create a remote directory (and parents). Directories confirmed earlier in
+        this run (including every ancestor) are remembered, so usually only the
+        new batch dir itself needs one SFTP mkdir. When several levels are
+        missing, one `mkdir -p` exec is tried first; accounts without a shell
+        (exec refused, or ForceCommand internal-sftp answering it) fall back
+        to per-level SFTP mkdir.
+        """
+        prefixes = []
+        cur = ""
+        for p in path.strip("/").split("/"):
+            cur = f"{cur}/{p}" if cur else f"/{p}"
+            prefixes.append(cur)
+        if prefixes[-1] in self._made_dirs:
+            return
+        known = max((i for i, d in enumerate(prefixes) if d in self._made_dirs), default=-1)
+        missing = prefixes[known + 1:]
+        ok = len(missing) > 1 and self._exec_mkdir(prefixes[-1])
+        with self.acquire() as sftp:
+            if ok:
+                # internal-sftp can exit 0 without running mkdir; confirm it's there
+                try:
+                    sftp.stat(prefixes[-1])
+                except IOError:
+                    ok = False
+            if not ok:
+                for i, cur in enumerate(missing):
+                    if i < len(missing) - 1:
+                        try:
+                            sftp.stat(cur)
+                            continue
+                        except IOError:
+                            pass
+                    try:
+                        sftp.mkdir(cur)
+                    except IOError:
+                        sftp.stat(cur)  # already there (e.g. a concurrent batch made it)
+        self._made_dirs.update(prefixes)
+
+    def release(self, sftp, broken=False):
+        with self._cond:
+            if broken:
+                self._discard(sftp)
+            else:
+                self._idle.append(sftp)
+                self._cond.notify()
+
+    @contextlib.contextmanager
+    def acquire(self):
+        sftp = self._get()
+        try:
+            yield sftp
+        except Exception:
+            self.release(sftp, broken=True)
+            raise
+        self.release(sftp)
+
+    def close(self):
+        with self._cond:
+            for sftp in self._idle:
+                sftp.close()
+            self._idle.clear()
+            self._open = 0
+        with self._lock:
+            if self._ssh is not None:
+                self._ssh.close()
+                self._ssh = None
+
+def upload_batch_sftp(batch_dir: pathlib.Path, cfg: dict, pool: SFTPPool, files=None, on_uploaded=None):
     remote_dir = cfg["remote_dir"]
-    pkey_path = cfg.get("private_key")
-    password = cfg.get("password")  # discourage, but allow
-
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    if pkey_path:
-        key = paramiko.Ed25519Key.from_private_key_file(pkey_path) if pkey_path.endswith("ed25519") \
-              else paramiko.RSAKey.from_private_key_file(pkey_path)
-        ssh.connect(host, port=port, username=username, pkey=key, timeout=10)
-    else:
-        ssh.connect(host, port=port, username=username, password=password, timeout=10)
-    sftp = ssh.open_sftp()
 
     # Create remote subdir: remote_dir/YYYY/MM/DD/HHMMSSZ/
     yyyy, mm, dd, stamp = batch_dir.parts[-4], batch_dir.parts[-3], batch_dir.parts[-2], batch_dir.parts[-1]
     sub = f"{remote_dir}/{yyyy}/{mm}/{dd}/{stamp}"
-    # ensure path exists
-    def sftp_mkdir_p(path):
-        parts = path.strip("/").split("/")
-        cur = ""
-        for p in parts:
-            cur = f"{cur}/{p}" if cur else f"/{p}"
-            try:
-                sftp.stat(cur)
-            except IOError:
-                sftp.mkdir(cur)
-    sftp_mkdir_p(sub)
+    pool.mkdir_p(sub)
 
-    for f in batch_dir.iterdir():
-        if f.is_file():
-            sftp.put(str(f), f"{sub}/{f.name}")
+    if files is None:
+        files = list_batch_files(batch_dir)
 
-    sftp.close()
-    ssh.close()
-    return True
+    def put(f):
+        try:
+            # each worker borrows its own channel on the shared transport
+            with pool.acquire() as sftp:
+                sftp_fast_put(sftp, f, f"{sub}/{f.name}")
+            if on_uploaded:
+                on_uploaded(f)
+            return None
+        except Exception as e:
+            return f, e
+
+    with ThreadPoolExecutor(max_workers=pool.size) as ex:
+        errors = [r for r in ex.map(put, files) if r]
+    for f, e in errors:
+        print(f"[uploader] SFTP upload failed for {f}: {e}")
+    return not errors
 
 # ----------------- Main runner -----------------
 
-def main():
-    cfg_path = "/etc/companion/config.yaml" if os.path.exists("/etc/companion/config.yaml") else "config.yaml"
+_cfg_cache = {}  # path -> (st_mtime_ns, cfg)
+
+def load_config(cfg_path: str) -> dict:
+    mtime = os.stat(cfg_path).st_mtime_ns
+    hit = _cfg_cache.get(cfg_path)
+    if hit and hit[0] == mtime:
+        return hit[1]
     with open(cfg_path, "r") as fh:
-        cfg = yaml.safe_load(fh)
+        cfg = yaml.load(fh, Loader=SafeLoader)
+    _cfg_cache[cfg_path] = (mtime, cfg)
+    return cfg
 
+def upload_pending(cfg: dict, ledger: UploadLedger, sftp_pool=None):
     data_root = cfg["data_root"]
     backend = cfg["uploader"]["backend"]
 
-    if not internet_up():
-        print("[uploader] No internet — exiting.")
-        return 0
+    if not internet_up(cache_path=os.path.join(data_root, ".net_probe")):
+        print("[uploader] No internet — skipping.")
+        return
 
-    pending = list(find_pending_batches(data_root))
+    pending = list(find_pending_batches(data_root, ledger))
     if not pending:
         print("[uploader] Nothing to upload.")
-        return 0
+        return
 
-    for batch_dir in sorted(pending):
+    def process_one(item):
+        batch_dir, files = item
+        batch_id = batch_id_of(batch_dir)
+        ok = False
         try:
             print(f"[uploader] Processing {batch_dir}")
-            mark_uploading(batch_dir)
+            ledger.mark_uploading(batch_id)
+            # resume: skip files a previous attempt already got across
+            if files is None:
+                files = list_batch_files(batch_dir)
+            sent = ledger.uploaded_files(batch_id)
+            files = [f for f in files if f.name not in sent]
+            on_uploaded = lambda f: ledger.mark_file_uploaded(batch_id, f.name)
 
             if backend == "local":
-                ok = upload_batch_local(batch_dir, cfg["uploader"]["local"]["dest_dir"])
+                ok = upload_batch_local(batch_dir, cfg["uploader"]["local"])
             elif backend == "s3":
-                ok = upload_batch_s3(batch_dir, cfg["uploader"]["s3"])
+                ok = upload_batch_s3(batch_dir, cfg["uploader"]["s3"], files, on_uploaded)
             elif backend == "sftp":
-                ok = upload_batch_sftp(batch_dir, cfg["uploader"]["sftp"])
+                ok = upload_batch_sftp(batch_dir, cfg["uploader"]["sftp"], sftp_pool, files, on_uploaded)
             else:
                 print(f"[uploader] Unknown backend: {backend}")
                 ok = False
 
             if ok:
-                mark_uploaded(batch_dir)
+                ledger.mark_uploaded(batch_id)
                 print(f"[uploader] Uploaded OK: {batch_dir}")
             else:
-                # leave .uploading to help you diagnose; you can remove it manually if needed
+                # the next attempt (after backoff) retries only the missing files
                 print(f"[uploader] Upload FAILED: {batch_dir}")
 
         except Exception as e:
             print(f"[uploader] Error on {batch_dir}: {e}")
+        if not ok:
+            try:
+                ledger.mark_failed(batch_id)
+            except Exception as e:
+                print(f"[uploader] Could not record failure for {batch_dir}: {e}")
+
+    # Several batches in flight at once; the S3 client and SFTP pool are shared
+    # Submit only as slots free up, so prefetch_batches stays a bounded look-ahead
+    n = cfg["uploader"].get("batch_concurrency", 4)
+    slots = threading.BoundedSemaphore(n)
+    with ThreadPoolExecutor(max_workers=n) as ex:
+        for item in prefetch_batches(sorted(pending)):
+            slots.acquire()
+            ex.submit(process_one, item).add_done_callback(lambda _: slots.release())
+
+class BatchWatcher:
+    """
+    Sets `wake` whenever a batch gets its meta.json, i.e. a capture has
+    finished. Only today's UTC day dir is watched, so the inotify watch count
+    stays at one day's batches instead of growing with the archive; refresh()
+    moves the watch when the day rolls over. Anything it misses is still
+    picked up by the interval poll. Needs watchdog; without it we just poll.
+    """
+    def __init__(self, data_root: str, wake: threading.Event):
+        self.data_root = data_root
+        self.wake = wake
+        self._observer = None
+        self._watch = None
+        self._day = None
+        self._warned = False
+
+    def start(self) -> bool:
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+        data_root, wake = self.data_root, self.wake
+
+        class Handler(FileSystemEventHandler):
+            def on_created(self, event):
+                # capture's atomic_write renames meta.json into place; anything
+                # else is ignored
+                path = getattr(event, "dest_path", "") or event.src_path
+                if os.path.basename(path) != "meta.json":
+                    return
+                rel = os.path.relpath(os.path.dirname(path), data_root).replace(os.sep, "/")
+                if _BATCH_RE.fullmatch(rel):
+                    wake.set()
+            on_moved = on_created
+
+        self._handler = Handler()
+        self._observer = Observer()
+        self._observer.daemon = True
+        self._observer.start()
+        self.refresh()
+        return True
+
+    def _stopped(self, why: str):
+        if not self._warned:
+            print(f"[uploader] File watcher stopped ({why}) — falling back to polling.")
+            self._warned = True
+
+    def refresh(self):
+        if self._observer is None or self._warned:
+            return
+        if not self._observer.is_alive():
+            self._stopped("observer thread died")
+            return
+        day = time.strftime("%Y/%m/%d", time.gmtime())
+        if day == self._day:
+            return
+        path = os.path.join(self.data_root, *day.split("/"))
+        try:
+            os.makedirs(path, exist_ok=True)
+            if self._watch is not None:
+                self._observer.unschedule(self._watch)
+            self._watch = self._observer.schedule(self._handler, path, recursive=True)
+        except OSError as e:
+            # e.g. fs.inotify.max_user_watches exhausted
+            self._observer.stop()
+            self._stopped(str(e))
+            return
+        self._day = day
+
+def main():
+    cfg_path = "/etc/companion/config.yaml" if os.path.exists("/etc/companion/config.yaml") else "config.yaml"
+    cfg = load_config(cfg_path)
+    up = cfg["uploader"]
+    backend = up["backend"]
+
+    run_lock = acquire_run_lock(cfg["data_root"])
+    if run_lock is None:
+        print("[uploader] Another uploader is running — exiting.")
+        return 0
+
+    # Clients live for the whole process; in daemon mode they're reused every pass
+    ledger = UploadLedger(cfg["data_root"], up.get("max_attempts"), up.get("retry_backoff_s", 300),
+                          up.get("retry_backoff_max_s", 3600))
+    sftp_pool = SFTPPool(up["sftp"], up["sftp"].get("pool_size", 4)) if backend == "sftp" else None
+    if backend == "s3":
+        get_s3_client(up["s3"], up.get("batch_concurrency", 4))
 
-    return 0
+    try:
+        if not up.get("daemon", False):
+            upload_pending(cfg, ledger, sftp_pool)
+            return 0
+
+        # Long-running mode: wake on new batches (watchdog) or every interval_s.
+        # The config, ledger and clients are fixed at startup; restart the
+        # uploader to pick up config changes.
+        wake = threading.Event()
+        watcher = BatchWatcher(cfg["data_root"], wake)
+        watcher.start()
+        while True:
+            wake.clear()
+            watcher.refresh()
+            try:
+                upload_pending(cfg, ledger, sftp_pool)
+            except Exception as e:
+                # a bad pass (e.g. data_root briefly unreadable) shouldn't end the daemon
+                print(f"[uploader] Pass failed: {e}")
+            wake.wait(up.get("interval_s", 60))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if sftp_pool:
+            sftp_pool.close()
+        ledger.close()
+        os.close(run_lock)
 
 if __name__ == "__main__":
     sys.exit(main())